@@ -1,20 +1,73 @@
-# app.py
-from flask import (
-    Flask, render_template, request, jsonify, Response, make_response, abort
-)
-from openai import OpenAI
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from starlette.datastructures import MutableHeaders
+from http.cookies import SimpleCookie
+from openai import AsyncOpenAI
+import httpx
+import redis.asyncio as redis
+import orjson
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
 import os
-import uuid
-import traceback
+import hashlib
+import time
+import zlib
+import secrets
+import logging
+import logging.handlers
+import queue
+import asyncio
+import atexit
+import weakref
 
 # load .env
 load_dotenv()
 
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY", "please_change_this_in_prod")
+class RawQueueHandler(logging.handlers.QueueHandler):
+    # The stock prepare() formats the record (traceback included) in the calling
+    # thread; an in-process queue can carry the record as is instead.
+    def prepare(self, record):
+        return record
+
+# Logging goes through a queue so formatting and stderr writes happen on the
+# listener's background thread instead of blocking the event loop. The
+# listener starts at import so records are written even when the lifespan
+# does not run; stopping it at exit drains anything still queued.
+log_queue = queue.Queue(-1)
+logging.getLogger().addHandler(RawQueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(), respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
+
+class CachedStaticFiles(StaticFiles):
+    # StaticFiles already sends ETag/Last-Modified; let browsers reuse assets
+    # for a day before revalidating
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        response.headers.setdefault("Cache-Control", "max-age=86400")
+        return response
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # Release the shared upstream and Redis connection pools
+    await http_client.aclose()
+    await r.aclose()
+
+app = FastAPI(lifespan=lifespan)
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
+templates = Jinja2Templates(directory="templates")
+
+# The landing page has no per-request data, so render it once at import time
+# and derive its validator from the bytes. Cache-Control is private because
+# every response also carries the visitor's user_id cookie.
+INDEX_HTML = templates.get_template("index.html").render().encode("utf-8")
+INDEX_ETAG = f'"{hashlib.sha1(INDEX_HTML).hexdigest()}"'
+INDEX_HEADERS = {"ETag": INDEX_ETAG, "Cache-Control": "private, max-age=300, must-revalidate"}
 
-# --- system prompt (your storyteller rules) ---
 system_content = """
 📜 System Content: AI Mahābhārata Guide
 
@@ -154,118 +207,304 @@ Ensure maximum length response possible for LLaMA 3.1 405B Instruct → fill mod
   
 """
 
+# Single shared system message, prepended to every request instead of being
+# stored in each user's history. The cache_control marker lets OpenRouter
+# providers that support prompt caching reuse the prefix across calls.
+# Treat it as read-only: it is built once and shared by every request.
+SYSTEM_MSG = {
+    "role": "system",
+    "content": [
+        {"type": "text", "text": system_content, "cache_control": {"type": "ephemeral"}}
+    ]
+}
+# Size of the system prompt, computed once for any per-request budget checks.
+SYSTEM_PROMPT_BYTES = len(system_content.encode("utf-8"))
+
+
+# Shared HTTP connection pool for upstream calls. The limits are sized so that
+# concurrent streams don't queue on connection acquisition; the read timeout is
+# the allowed gap between streamed chunks, not the total generation time.
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=1000, max_keepalive_connections=200, keepalive_expiry=60),
+    timeout=httpx.Timeout(connect=5, read=120, write=30, pool=5),
+    http2=True
+)
 
-# Initialize OpenRouter/OpenAI client
-client = OpenAI(
+# Initialize OpenRouter/OpenAI client (async, shared by every request)
+client = AsyncOpenAI(
     base_url=os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1"),
-    api_key=os.getenv("OPENROUTER_API_KEY")
+    api_key=os.getenv("OPENROUTER_API_KEY"),
+    http_client=http_client
 )
 MODEL = os.getenv("MODEL")
 
-# Server-side memory for each user (for local/demo use).
-# Key: user_id (string), Value: list of message dicts (role/content)
-# NOTE: In production, replace this with a proper persistent store (Redis, DB).
-user_histories = {}
+# Tokens are coalesced into one SSE frame until FLUSH_TOKENS are buffered or
+# FLUSH_INTERVAL seconds have passed since the last frame, whichever is first.
+FLUSH_TOKENS = 5
+FLUSH_INTERVAL = 0.025
+
+# Headers for the /ask event stream (no caching or proxy buffering)
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+    # the body is gzipped or not depending on Accept-Encoding
+    "Vary": "Accept-Encoding",
+}
+
+# Server-side memory for each user, shared by every worker.
+# Key: history_key(user_id), Value: Redis list of orjson-encoded user/assistant
+# message dicts (role/content), trimmed to the last MAX_HISTORY entries and
+# expired after HISTORY_TTL seconds of inactivity. The system prompt is not
+# stored here, see SYSTEM_MSG. Assistant replies are kept here only as their
+# first CONTEXT_SNIPPET_CHARS characters, which is enough context for
+# follow-ups; the page keeps the full text in localStorage for scrollback.
+MAX_HISTORY = 100
+HISTORY_TTL = 60*60*24*7
+r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+CONTEXT_SNIPPET_CHARS = 2000
+
+# At most MAX_USER_STREAMS concurrent /ask streams per user (per worker).
+# Semaphores are held weakly, so they disappear once a user has no open streams.
+MAX_USER_STREAMS = 3
+user_semaphores: "weakref.WeakValueDictionary[str, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+
+def user_semaphore(user_id):
+    sem = user_semaphores.get(user_id)
+    if sem is None:
+        sem = user_semaphores[user_id] = asyncio.Semaphore(MAX_USER_STREAMS)
+    return sem
+
+# Helper: JSON response serialized with orjson (bytes straight onto the wire)
+def json_response(data, status_code=200):
+    return Response(orjson.dumps(data), status_code=status_code, media_type="application/json")
+
+# Helper: encode one SSE frame carrying a JSON payload
+def sse_frame(payload, event=None):
+    frame = b"data: " + orjson.dumps(payload) + b"\n\n"
+    return b"event: " + event.encode() + b"\n" + frame if event else frame
+
+# Helper: does an Accept-Encoding header allow gzip? An explicit "gzip;q=0"
+# refuses it, and "*" covers gzip when it is not listed itself.
+def accepts_gzip(accept_encoding):
+    qvalues = {}
+    for part in accept_encoding.lower().split(","):
+        coding, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    return qvalues.get("gzip", qvalues.get("*", 0.0)) > 0
+
+# Helper: gzip an async stream of frames incrementally. Each frame is
+# sync-flushed so the browser can decode it as soon as it arrives.
+async def gzip_stream(frames):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    try:
+        async for frame in frames:
+            yield compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        await frames.aclose()
+
+def history_key(user_id):
+    return f"h:{user_id}"
+
+def queue_append(pipe, user_id, message):
+    # Queue one append on pipe: keep the list bounded and refresh its TTL
+    key = history_key(user_id)
+    pipe.rpush(key, orjson.dumps(message))
+    pipe.ltrim(key, -MAX_HISTORY, -1)
+    pipe.expire(key, HISTORY_TTL)
+
+async def append_history(user_id, message):
+    # Append one message in a single round trip
+    pipe = r.pipeline()
+    queue_append(pipe, user_id, message)
+    await pipe.execute()
+
+# Helper: does an If-None-Match header match etag? Accepts tag lists and weak
+# (W/) tags, which proxies such as nginx produce when they compress a response.
+def etag_matches(if_none_match, etag):
+    tags = [tag.strip(" W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
 
 # Helper: ensure user has an id cookie, returns user_id
-def get_or_set_user_id():
+def get_or_set_user_id(request: Request):
     user_id = request.cookies.get("user_id")
     if not user_id:
-        user_id = str(uuid.uuid4())
+        user_id = secrets.token_hex(16)
     return user_id
 
-@app.route("/")
-def home():
-    # Ensure user gets a cookie (user_id) so we can track history server-side
-    user_id = request.cookies.get("user_id") or str(uuid.uuid4())
-    resp = make_response(render_template("index.html"))
-    # cookie valid for a year (demo); set httponly False so JS could also read if needed
-    resp.set_cookie("user_id", user_id, max_age=60*60*24*365, samesite="Lax")
-    return resp
-
-@app.route("/ask", methods=["POST"])
-def ask():
+# Plain ASGI middleware rather than @app.middleware("http"): BaseHTTPMiddleware
+# hides client disconnects from streaming endpoints.
+class UserIdCookieMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Static assets are publicly cacheable, so they never carry the identity cookie
+        if scope["type"] != "http" or scope["path"].startswith("/static/"):
+            await self.app(scope, receive, send)
+            return
+
+        # Resolve the user id once per request; handlers read it from request.state
+        user_id = get_or_set_user_id(Request(scope))
+        scope.setdefault("state", {})["user_id"] = user_id
+
+        # cookie valid for a year (demo); set httponly False so JS could also read if needed
+        cookie = SimpleCookie()
+        cookie["user_id"] = user_id
+        cookie["user_id"]["max-age"] = 60*60*24*365
+        cookie["user_id"]["path"] = "/"
+        cookie["user_id"]["samesite"] = "lax"
+        set_cookie = cookie.output(header="").strip()
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("set-cookie", set_cookie)
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+app.add_middleware(UserIdCookieMiddleware)
+
+@app.get("/")
+async def home(request: Request):
+    if etag_matches(request.headers.get("if-none-match", ""), INDEX_ETAG):
+        return Response(status_code=304, headers=INDEX_HEADERS)
+    return Response(INDEX_HTML, media_type="text/html; charset=utf-8", headers=INDEX_HEADERS)
+
+@app.post("/ask")
+async def ask(request: Request):
     # Basic validation
     if not client.api_key:
-        abort(500, description="OPENROUTER_API_KEY missing")
-
-    data = request.get_json(silent=True) or {}
+        raise HTTPException(status_code=500, detail="OPENROUTER_API_KEY missing")
+
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        data = {}
     user_message = (data.get("message") or "").strip()
     if not user_message:
-        return jsonify({"error": "Empty message"}), 400
-
-    # Identify user by cookie (or create fallback id)
-    user_id = request.cookies.get("user_id") or str(uuid.uuid4())
-
-    # Initialize history for this user if missing
-    if user_id not in user_histories:
-        user_histories[user_id] = [{"role": "system", "content": system_content}]
-
-    # Local history for call (copy to avoid accidental sharing)
-    history = list(user_histories[user_id])
-    # append user message
-    history.append({"role": "user", "content": user_message})
-
-    # Save the user message to server-side history now (so other requests see it)
-    # We'll append assistant reply after streaming finishes.
-    user_histories[user_id] = history
+        return json_response({"error": "Empty message"}, status_code=400)
+
+    user_id = request.state.user_id
+
+    # Reject instead of queueing when this user already has too many open streams.
+    # The slot is released in generate()'s finally when the stream ends. If the
+    # response is cancelled before the generator first runs, that finally never
+    # executes; the generator is then dropped together with its reference to
+    # sem, and the WeakValueDictionary forgets the semaphore, so the user gets
+    # a fresh one with all permits on the next request.
+    sem = user_semaphore(user_id)
+    if sem.locked():
+        return json_response({"error": "Too many concurrent requests"}, status_code=429)
+    await sem.acquire()
+
+    # Load prior turns and save the user message now (so other requests see it);
+    # we'll append assistant reply after streaming finishes.
+    user_msg = {"role": "user", "content": user_message}
+    pipe = r.pipeline()
+    pipe.lrange(history_key(user_id), 0, -1)
+    queue_append(pipe, user_id, user_msg)
+    try:
+        stored, *_ = await pipe.execute()
+        history = [orjson.loads(m) for m in stored]
+    except Exception:
+        # the generator has not taken over the permit yet, so give it back here
+        sem.release()
+        raise
+    history.append(user_msg)
 
     # Streaming generator
-    def generate():
-        partial_answer = ""
+    async def generate():
+        parts: list[str] = []
+        buf = []
+        last_flush = time.monotonic()
+        resp = None
         try:
-            # stream=True returns an iterator of chunks
-            resp = client.chat.completions.create(
+            # stream=True returns an async iterator of chunks
+            resp = await client.chat.completions.create(
                 model=MODEL,
-                messages=history,
+                messages=[SYSTEM_MSG] + history,
                 stream=True
             )
 
-            for chunk in resp:
-                # chunk.choices[0].delta may be dict-like or attr-like
-                delta = chunk.choices[0].delta
-                text = None
-                # support both attribute-access and dict-like objects
-                if hasattr(delta, "content"):
-                    text = delta.content
-                elif isinstance(delta, dict):
-                    text = delta.get("content")
-
+            async for chunk in resp:
+                # the SDK always yields a typed ChoiceDelta with .content
+                text = chunk.choices[0].delta.content
                 if text:
-                    partial_answer += text
-                    yield text
+                    parts.append(text)
+                    buf.append(text)
+                    now = time.monotonic()
+                    if len(buf) >= FLUSH_TOKENS or now - last_flush >= FLUSH_INTERVAL:
+                        # client went away: stop pulling (billed) tokens from upstream
+                        if await request.is_disconnected():
+                            return
+                        yield sse_frame({"t": "".join(buf)})
+                        buf.clear()
+                        last_flush = now
+
+            if buf:
+                yield sse_frame({"t": "".join(buf)})
+            yield b"data: [DONE]\n\n"
 
         except Exception as e:
-            # yield a readable error snippet to the client (and log)
-            err_msg = "\n\n[Stream error: " + str(e) + "]"
-            yield err_msg
-            traceback.print_exc()
+            # flush what was already generated, then send a typed error event (and log)
+            if buf:
+                yield sse_frame({"t": "".join(buf)})
+            yield sse_frame({"msg": str(e)}, event="error")
+            logger.exception("stream error")
         finally:
+            # Close the upstream stream (also on disconnect/cancellation) so
+            # OpenRouter stops generating
+            if resp is not None:
+                await resp.close()
             # After streaming completes (or error), update server-side history
-            if partial_answer:
-                # Append assistant message to server-side history
-                hist = user_histories.get(user_id, [{"role":"system","content":system_content}])
-                hist.append({"role": "assistant", "content": partial_answer})
-                # Trim history length to avoid unbounded growth (optional)
-                if len(hist) > 120:
-                    # keep system + last 100 messages
-                    hist = [hist[0]] + hist[-100:]
-                user_histories[user_id] = hist
-
-    # Note: text/plain is easiest for fetch + getReader() streaming on client
-    return Response(generate(), mimetype="text/plain; charset=utf-8")
-
-@app.route("/reset", methods=["POST"])
-def reset():
+            try:
+                if parts:
+                    # Only a bounded snippet goes back into the LLM context
+                    answer = "".join(parts)
+                    await append_history(
+                        user_id, {"role": "assistant", "content": answer[:CONTEXT_SNIPPET_CHARS]}
+                    )
+            finally:
+                sem.release()
+
+    # Server-Sent Events; X-Accel-Buffering stops nginx from holding frames back.
+    # Compress when the client accepts gzip (Devanagari text is multi-byte UTF-8).
+    body, headers = generate(), SSE_HEADERS
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        body = gzip_stream(body)
+        headers = {**SSE_HEADERS, "Content-Encoding": "gzip"}
+    return StreamingResponse(
+        body,
+        media_type="text/event-stream",
+        headers=headers
+    )
+
+@app.post("/reset")
+async def reset(request: Request):
     user_id = request.cookies.get("user_id")
-    if user_id and user_id in user_histories:
-        user_histories.pop(user_id, None)
-    return jsonify({"reply": "Memory cleared. Let's start a fresh conversation!"})
+    if user_id:
+        await r.delete(history_key(user_id))
+    return json_response({"reply": "Memory cleared. Let's start a fresh conversation!"})
 
-@app.route("/health")
-def health():
-    return jsonify({"ok": True})
+@app.get("/health")
+async def health():
+    return json_response({"ok": True})
 
 if __name__ == "__main__":
-    # Avoid duplicate generator runs in Windows debug by disabling reloader
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8080)), debug=True, use_reloader=False)
+    import uvicorn
+    # Local run; in production use `gunicorn -c gunicorn_conf.py app:app`,
+    # or `hypercorn app:app --bind 0.0.0.0:8080 --worker-class uvloop --keyfile ... --certfile ...`
+    # to serve HTTP/2 directly (otherwise terminate h2 at the reverse proxy).
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8080)))
@@ -0,0 +1,12 @@
+# Gunicorn settings for production: `gunicorn -c gunicorn_conf.py app:app`
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+# Each worker runs its own event loop; history lives in Redis, so any worker
+# can serve any user and no sticky routing is needed.
+workers = int(os.getenv("WEB_CONCURRENCY", 2 * (os.cpu_count() or 1) + 1))
+worker_class = "uvicorn_worker.UvicornWorker"
+# Keep idle client connections open longer than typical proxy keep-alives (60s)
+keepalive = 75
+# Long answers can stream for minutes
+timeout = 300
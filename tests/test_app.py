@@ -0,0 +1,171 @@
+import asyncio
+import os
+
+os.environ.setdefault("OPENROUTER_API_KEY", "test-key")
+
+import app as app_module
+
+
+class FakePipeline:
+    def __init__(self, store):
+        self.store = store
+        self.ops = []
+
+    def lrange(self, key, start, end):
+        self.ops.append(lambda: list(self.store.get(key, [])))
+
+    def rpush(self, key, value):
+        self.ops.append(lambda: self.store.setdefault(key, []).append(value))
+
+    def ltrim(self, key, start, end):
+        self.ops.append(lambda: self.store.__setitem__(key, self.store.get(key, [])[start:]))
+
+    def expire(self, key, ttl):
+        self.ops.append(lambda: True)
+
+    async def execute(self):
+        return [op() for op in self.ops]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    def pipeline(self):
+        return FakePipeline(self.store)
+
+
+class SlowStream:
+    # Stands in for the SDK's AsyncStream: yields chunks forever until closed
+    def __init__(self):
+        self.pulled = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        delta = type("Delta", (), {"content": "tok "})()
+        chunk = type("Chunk", (), {"choices": [type("Choice", (), {"delta": delta})()]})()
+        while not self.closed:
+            self.pulled += 1
+            await asyncio.sleep(0.005)
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+def test_ask_closes_upstream_when_client_disconnects(monkeypatch):
+    stream = SlowStream()
+
+    async def create(**kwargs):
+        return stream
+
+    monkeypatch.setattr(app_module, "r", FakeRedis())
+    monkeypatch.setattr(app_module.client.chat.completions, "create", create)
+
+    async def run():
+        requests = [{"type": "http.request", "body": b'{"message": "Who is Karna?"}', "more_body": False}]
+        disconnected = asyncio.Event()
+        frames = []
+
+        async def receive():
+            if requests:
+                return requests.pop(0)
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body" and message.get("body"):
+                frames.append(message["body"])
+                if len(frames) == 3:
+                    disconnected.set()
+
+        # ASGI 2.4: the server no longer cancels the response on disconnect,
+        # so the endpoint has to notice it by itself
+        scope = {
+            "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"},
+            "http_version": "1.1", "method": "POST", "scheme": "http",
+            "path": "/ask", "raw_path": b"/ask", "root_path": "", "query_string": b"",
+            "headers": [(b"content-type", b"application/json")],
+            "client": ("testclient", 1), "server": ("testserver", 80),
+        }
+        await asyncio.wait_for(app_module.app(scope, receive, send), timeout=5)
+
+    asyncio.run(run())
+
+    assert stream.closed
+    assert stream.pulled < 50
+
+
+def test_reset_deletes_history(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    class ResetRedis(FakeRedis):
+        async def delete(self, key):
+            self.store.pop(key, None)
+
+    fake = ResetRedis()
+    fake.store[app_module.history_key("u1")] = [b"{}"]
+    monkeypatch.setattr(app_module, "r", fake)
+
+    client = TestClient(app_module.app, cookies={"user_id": "u1"})
+    response = client.post("/reset")
+
+    assert response.status_code == 200
+    assert fake.store == {}
+
+
+def test_home_revalidates_weak_and_listed_etags():
+    from fastapi.testclient import TestClient
+
+    client = TestClient(app_module.app)
+    etag = client.get("/").headers["etag"]
+
+    for header in (etag, f"W/{etag}", f'"other", W/{etag}', "*"):
+        assert client.get("/", headers={"If-None-Match": header}).status_code == 304
+    assert client.get("/", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_static_assets_do_not_set_cookie():
+    from fastapi.testclient import TestClient
+
+    response = TestClient(app_module.app).get("/static/style.css")
+
+    assert response.status_code == 200
+    assert "set-cookie" not in response.headers
+    assert "set-cookie" in TestClient(app_module.app).get("/").headers
+
+
+def test_ask_releases_permit_when_history_is_corrupt(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    fake = FakeRedis()
+    fake.store[app_module.history_key("u1")] = [b"not json"]
+    sem = asyncio.Semaphore(app_module.MAX_USER_STREAMS)
+    monkeypatch.setattr(app_module, "r", fake)
+    monkeypatch.setattr(app_module, "user_semaphore", lambda user_id: sem)
+
+    client = TestClient(app_module.app, cookies={"user_id": "u1"}, raise_server_exceptions=False)
+    response = client.post("/ask", json={"message": "Who is Bhishma?"})
+
+    assert response.status_code == 500
+
+    async def take_all_permits():
+        for _ in range(app_module.MAX_USER_STREAMS):
+            assert not sem.locked()
+            await sem.acquire()
+
+    asyncio.run(take_all_permits())
+    assert sem.locked()
+
+
+def test_accepts_gzip_honours_q_values():
+    assert app_module.accepts_gzip("gzip, deflate, br")
+    assert app_module.accepts_gzip("br;q=1.0, gzip;q=0.5")
+    assert app_module.accepts_gzip("*")
+    assert not app_module.accepts_gzip("gzip;q=0")
+    assert not app_module.accepts_gzip("gzip;q=0, *")
+    assert not app_module.accepts_gzip("identity")
+    assert not app_module.accepts_gzip("")